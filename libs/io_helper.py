@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
+import errno
 import glob
 import os
 import pathlib
 import shutil
+import stat
 import subprocess
 import tarfile
-from typing import Optional
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
 
 from libs.system_helper import Architecture
 
@@ -39,12 +44,111 @@ class Paths:
     PACKAGES_OUT = os.path.join(
         pathlib.Path(__file__).parent.parent.resolve(), "packages"
     )
+    # On-disk cache of `nix-env -qa` output
+    REMOTE_PKGS_CACHE = os.path.expanduser("~/.cache/nix2pkg/remote_pkgs.json")
+
+
+# Read/copy buffer for tar extraction; tarfile's defaults (10 KiB stream
+# reads, 16 KiB copies) make extracting large archives loop-bound in Python
+TAR_BUFSIZE = 256 * 1024
 
 
 class WrongArchiveType(Exception):
     pass
 
 
+# Number of store entries to process at once, tunable for slow or networked disks
+def _io_concurrency() -> int:
+    try:
+        return max(1, int(os.environ.get("NIX2PKG_IO_CONCURRENCY", 32)))
+    except ValueError:
+        return 32
+
+
+# Run func over every top-level entry of root in parallel; entries are independent
+# Hidden entries (e.g. .links) are skipped unless asked for, as the previous glob did
+def _for_each_entry(
+    root: str, func: Callable[[str], None], include_hidden: bool = False
+) -> None:
+    with os.scandir(root) as it:
+        paths = [
+            entry.path
+            for entry in it
+            if include_hidden or not entry.name.startswith(".")
+        ]
+    with ThreadPoolExecutor(max_workers=_io_concurrency()) as ex:
+        list(ex.map(func, paths))
+
+
+# Delete a store entry in a single walk, making each directory writable
+# just before emptying it, and ignore whatever we can't remove
+def _remove_store_entry(item: str) -> None:
+    if os.path.islink(item) or not os.path.isdir(item):
+        try:
+            os.unlink(item)
+        except OSError:
+            pass
+        return
+    try:
+        os.chmod(item, 0o755)
+        with os.scandir(item) as it:
+            entries = list(it)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            _remove_store_entry(entry.path)
+        else:
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
+    try:
+        os.rmdir(item)
+    except OSError:
+        pass
+
+
+# Delete a whole moved-aside store, entries in parallel, then the dir itself
+def _deep_rmtree(root: str) -> None:
+    _for_each_entry(root, _remove_store_entry, include_hidden=True)
+    try:
+        os.rmdir(root)
+    except OSError:
+        pass
+
+
+# Delete every moved-aside store, including any an interrupted run left behind
+def _empty_store_trash(store: str) -> None:
+    for trash in glob.glob(glob.escape(store) + ".trash.*"):
+        _deep_rmtree(trash)
+
+
+# Recursively chmod a tree in-process, leaving symlinks untouched like chmod -R
+def _chmod_tree(root: str, mode: int) -> None:
+    if os.path.islink(root):
+        return
+    try:
+        os.chmod(root, mode)
+        if not os.path.isdir(root):
+            return
+        with os.scandir(root) as it:
+            entries = list(it)
+    except OSError:
+        return
+    for entry in entries:
+        # DirEntry caches the file type, so this costs no extra stat
+        if entry.is_symlink():
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            _chmod_tree(entry.path, mode)
+        else:
+            try:
+                os.chmod(entry.path, mode)
+            except OSError:
+                pass
+
+
 class LocalIOHelper:
     # Untar and return extracted dir name
     def untar_archive(self, archivepath: str) -> str:
@@ -55,9 +159,19 @@ class LocalIOHelper:
         # Delete any previous extracted dir
         if os.path.isdir(extracted_name):
             shutil.rmtree(extracted_name)
-        tar = tarfile.open(archivepath)
-        tar.extractall()
-        tar.close
+
+        # Only the store and .reginfo are used by install_files/initial_setup,
+        # so skip writing out docs and installer scripts; members live under
+        # a single top-level directory
+        def wanted(member: tarfile.TarInfo) -> bool:
+            rel = member.name.partition("/")[2]
+            return rel == ".reginfo" or rel == "store" or rel.startswith("store/")
+
+        # Streaming mode reads the xz archive front to back without seeking
+        with tarfile.open(
+            archivepath, mode="r|xz", bufsize=TAR_BUFSIZE, copybufsize=TAR_BUFSIZE
+        ) as tar:
+            tar.extractall(members=(member for member in tar if wanted(member)))
         return extracted_name
 
     # From the extracted dir, move out the files to the right place
@@ -78,20 +192,34 @@ class LocalIOHelper:
 
         # Move over the packages
         fresh = os.path.join(extracteddir, "store")
-        for pkg in os.listdir(fresh):
-            if os.path.exists(os.path.join(Paths.NIX_STORE, pkg)):
-                print("Already exists: " + str(pkg))
-            else:
-                shutil.move(os.path.join(fresh, pkg), Paths.NIX_STORE)
+        # Bound once as locals; this loop can run over thousands of packages
+        store, join, rename = Paths.NIX_STORE, os.path.join, os.rename
+        # One listing of the store instead of an exists() stat per package
+        with os.scandir(store) as it:
+            installed = {entry.name for entry in it}
+        with os.scandir(fresh) as it:
+            entries = list(it)
+        for entry in entries:
+            if entry.name in installed:
+                print("Already exists: " + entry.name)
+                continue
+            dst = join(store, entry.name)
+            try:
+                rename(entry.path, dst)
+            except OSError as e:
+                # The extracted dir may be on another volume than the store
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.move(entry.path, dst)
 
         # Following officlial installer which does chmod -R a-w
         # /nix/store should be writable because we want to add new stuff
         # /nix/store/* should be recursivly unwritable. Packages never modified
-        for item in glob.glob(os.path.join(Paths.NIX_STORE, "*")):
-            subprocess.run(["chmod", "-R", "555", item], stderr=subprocess.DEVNULL)
+        _for_each_entry(Paths.NIX_STORE, lambda item: _chmod_tree(item, 0o555))
 
-    # Remove all nix2rpm files
-    def removal(self) -> None:
+    # Remove all nix2rpm files; the old store is deleted by the returned
+    # thread, which callers may join if they need to wait for it
+    def removal(self) -> Optional[threading.Thread]:
         # remove .nix* files in ~
         print("Removing Nix files in home directory")
         channels = os.path.expanduser("~/.nix-channels")
@@ -114,9 +242,28 @@ class LocalIOHelper:
 
         # Remove store packages that we have permission to remove
         print("Removing installed packages")
-        for item in glob.glob(os.path.join(Paths.NIX_STORE, "*")):
-            subprocess.run(["chmod", "-R", "+w", item], stderr=subprocess.DEVNULL)
-            subprocess.run(["rm", "-rf", item], stderr=subprocess.DEVNULL)
+        if not os.path.isdir(Paths.NIX_STORE):
+            return None
+        # Swap in an empty store right away and delete the old one behind it
+        trash = f"{Paths.NIX_STORE}.trash.{os.getpid()}"
+        store_stat = os.stat(Paths.NIX_STORE)
+        try:
+            os.rename(Paths.NIX_STORE, trash)
+        except OSError:
+            # e.g. the store is a mount point, so delete in place instead
+            _for_each_entry(Paths.NIX_STORE, _remove_store_entry)
+            return None
+        # The new store must look like the old one: owner, group and mode
+        os.makedirs(Paths.NIX_STORE, exist_ok=True)
+        try:
+            os.chown(Paths.NIX_STORE, store_stat.st_uid, store_stat.st_gid)
+        except PermissionError:
+            print(f"Warning: could not restore ownership of {Paths.NIX_STORE}")
+        os.chmod(Paths.NIX_STORE, stat.S_IMODE(store_stat.st_mode))
+        # Not a daemon, so the interpreter finishes the delete before exiting
+        deleter = threading.Thread(target=_empty_store_trash, args=(Paths.NIX_STORE,))
+        deleter.start()
+        return deleter
 
     # Remove the downloaded files used for installation
     def clean_install_files(self, archivename: str) -> None:
@@ -148,16 +295,15 @@ class NetworkIOHelper:
     def download_release(self, public=True) -> str:
         # TODO: Replace this with DeterminateSystems installer pkg
         # if Architecture.is_x86():
-        #     return self._download_file_curl(self.release_url_x86)
+        #     return self._download_file(self.release_url_x86)
         # else:
-        #     return self._download_file_curl(self.release_url_arm)
+        #     return self._download_file(self.release_url_arm)
         return
 
-    # Download file in curl subprocess
-    def _download_file_curl(
-        self, target_url: str, file_name: Optional[str] = None
-    ) -> str:
+    # Download file in-process, streaming it to disk in 1 MiB chunks
+    def _download_file(self, target_url: str, file_name: Optional[str] = None) -> str:
         target = file_name if file_name else os.path.basename(target_url)
-        c = f'/usr/bin/curl -L "{target_url}" -o "{target}" '
-        subprocess.run([c], shell=True, stdout=subprocess.DEVNULL)
+        with urllib.request.urlopen(target_url, timeout=60) as response:
+            with open(target, "wb") as f:
+                shutil.copyfileobj(response, f, 1 << 20)
         return target
@@ -1,19 +1,60 @@
 #!/usr/bin/env python3
 import glob
+import json
 import os
 import pathlib
 import re
 import shutil
+import string
 import subprocess
 import tarfile
+import threading
 import time
-from contextlib import contextmanager
-from typing import List, Tuple
+from collections import defaultdict
+from typing import BinaryIO, Dict, List, Optional, Tuple
 
-from libs.io_helper import NetworkIOHelper, Paths
+from libs.io_helper import TAR_BUFSIZE, Paths
 from libs.system_helper import Architecture
 
 
+# Channel names such as 21.11, 23.05-pre or 23.11-beta
+_NIX_CHANNEL_RE = re.compile(r"^\d\d\.\d\d(-pre|-beta)?$")
+# Store path basenames are <32 char hash>-<name>
+_NIX_HASH_LEN = 32
+_NIX_HASH_CHARS = frozenset(string.ascii_lowercase + string.digits)
+
+# External decompressors by the stream's magic bytes, parallel variant first
+# when installed; anything else is treated as an uncompressed tar
+_DECOMPRESSORS = (
+    (b"\xfd7zXZ\x00", (["pixz", "-d"], ["xz", "-dc", "--threads=0"])),
+    (b"BZh", (["pbzip2", "-dc"], ["bzip2", "-dc"])),
+    (b"\x1f\x8b", (["pigz", "-dc"], ["gzip", "-dc"])),
+)
+_MAGIC_LEN = max(len(magic) for magic, _ in _DECOMPRESSORS)
+
+
+# Replays the bytes read to sniff the format before the rest of the stream
+class _PrefixedStream:
+    def __init__(self, prefix: bytes, stream: BinaryIO) -> None:
+        self._prefix = prefix
+        self._stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        if not self._prefix:
+            return self._stream.read(size)
+        if size < 0 or size >= len(self._prefix):
+            chunk, self._prefix = self._prefix, b""
+        else:
+            chunk, self._prefix = self._prefix[:size], self._prefix[size:]
+        return chunk
+
+
+# The nixpkgs tree is only read back by nix build, so don't restore mtimes
+class _NoMtimeTarFile(tarfile.TarFile):
+    def utime(self, tarinfo, targetpath):
+        pass
+
+
 class NixPackagePathNotFoundError(Exception):
     pass
 
@@ -28,49 +69,147 @@ class NixHelper:
     nix_env = os.path.join(Paths.NIX_BIN, "nix-env")
     nix_store = os.path.join(Paths.NIX_BIN, "nix-store")
 
+    def __init__(self) -> None:
+        # Per-instance caches, filled on first use
+        self._remote_packages: Optional[List[str]] = None
+        self._envs: Dict[bool, Dict[str, str]] = {}
+
     # Call nix-env with an argument and capture its output
     def _nix_env_shell_out(self, arguments: str) -> str:
-        with self._set_enviromentals():
-            result = subprocess.run([self.nix_env, arguments], capture_output=True)
+        result = subprocess.run(
+            [self.nix_env, arguments], capture_output=True, env=self._build_env()
+        )
         return result.stdout.decode("utf-8")
 
-    # Returns a list of remote nix packages
-    def get_all_remote_packages(self) -> List[str]:
-        package_list = self._nix_env_shell_out("-qa")
-        return package_list.split()
+    # Identifies the package set nix-env -qa lists: the channels link
+    # resolves to a new store path whenever the channel is updated
+    def _remote_packages_cache_key(self) -> str:
+        channels = os.path.expanduser("~/.nix-defexpr/channels")
+        return f"{Paths.NIX_PACKAGE}:{os.path.realpath(channels)}"
 
-    # Set enviromental variables for nix
-    @contextmanager
-    def _set_enviromentals(self, force_build: bool = False):
-        saved = dict(os.environ)
+    # Returns a list of remote nix packages, cached on disk per channel revision
+    def get_all_remote_packages(self) -> List[str]:
+        if self._remote_packages is None:
+            self._remote_packages = self._load_remote_packages()
+        return self._remote_packages
+
+    def _load_remote_packages(self) -> List[str]:
+        cache_key = self._remote_packages_cache_key()
+        try:
+            with open(Paths.REMOTE_PKGS_CACHE) as f:
+                cached = json.load(f)
+            if cached.get("key") == cache_key:
+                return cached["packages"]
+        except (OSError, ValueError, AttributeError):
+            pass
+        package_list = self._nix_env_shell_out("-qa").split()
+        if package_list:
+            try:
+                os.makedirs(os.path.dirname(Paths.REMOTE_PKGS_CACHE), exist_ok=True)
+                with open(Paths.REMOTE_PKGS_CACHE, "w") as f:
+                    json.dump({"key": cache_key, "packages": package_list}, f)
+            except OSError:
+                pass
+        return package_list
+
+    # Build the environment nix commands run with; cached since it only
+    # depends on force_build and the (unchanging) process environment
+    def _build_env(self, force_build: bool = False) -> Dict[str, str]:
+        if force_build not in self._envs:
+            self._envs[force_build] = self._make_env(force_build)
+        return self._envs[force_build]
+
+    def _make_env(self, force_build: bool) -> Dict[str, str]:
+        env = dict(os.environ)
         # See https://github.com/NixOS/nix/blob/master/tests/functional/common/vars-and-functions.sh.in
-        os.environ["NIX_STORE_DIR"] = Paths.NIX_STORE
-        os.environ["NIX_STATE_DIR"] = Paths.NIX_STATE
-        os.environ["NIX_LOG_DIR"] = Paths.NIX_LOG
-        os.environ["NIX_CONF_DIR"] = Paths.NIX_CONFIG
-        os.environ["NIX_SSL_CERT_FILE"] = (
-            Paths.CA_PACKAGE + "/etc/ssl/certs/ca-bundle.crt"
-        )
-
-        nix_link = f"{os.environ['HOME']}/.nix-profile"
-        os.environ["NIX_PATH"] = f"{os.environ['HOME']}/.nix-defexpr/channels"
-        os.environ[
-            "NIX_PROFILES"
-        ] = f"{Paths.NIX_PROFILES}/default {os.environ['HOME']}/.nix-profile"
-        os.environ["PATH"] = f"{nix_link}/bin:{os.environ['PATH']}"
-        os.environ["NIXPKGS_ALLOW_UNFREE"] = "1"  # Permits proprietary/unfree packages
+        env["NIX_STORE_DIR"] = Paths.NIX_STORE
+        env["NIX_STATE_DIR"] = Paths.NIX_STATE
+        env["NIX_LOG_DIR"] = Paths.NIX_LOG
+        env["NIX_CONF_DIR"] = Paths.NIX_CONFIG
+        env["NIX_SSL_CERT_FILE"] = Paths.CA_PACKAGE + "/etc/ssl/certs/ca-bundle.crt"
+
+        nix_link = f"{env['HOME']}/.nix-profile"
+        env["NIX_PATH"] = f"{env['HOME']}/.nix-defexpr/channels"
+        env["NIX_PROFILES"] = f"{Paths.NIX_PROFILES}/default {env['HOME']}/.nix-profile"
+        env["PATH"] = f"{nix_link}/bin:{env['PATH']}"
+        env["NIXPKGS_ALLOW_UNFREE"] = "1"  # Permits proprietary/unfree packages
         if force_build:
             # This shouldn't be the default, but some packages
             # just have to be built. It also helps with getting logs
             # for WHY a package is failing.
-            os.environ["NIXPKGS_ALLOW_INSECURE"] = "1"
-            os.environ["NIXPKGS_ALLOW_UNSUPPORTED_SYSTEM"] = "1"
-            os.environ["NIXPKGS_ALLOW_BROKEN"] = "1"
-
-        yield
-        # Restore previous enviromental vars state
-        os.environ.clear()
-        os.environ.update(saved)
+            env["NIXPKGS_ALLOW_INSECURE"] = "1"
+            env["NIXPKGS_ALLOW_UNSUPPORTED_SYSTEM"] = "1"
+            env["NIXPKGS_ALLOW_BROKEN"] = "1"
+        return env
+
+    # Pick the decompressor command for a tarball from its first bytes,
+    # None if it isn't compressed
+    def _decompress_cmd(self, head: bytes) -> Optional[List[str]]:
+        for magic, cmds in _DECOMPRESSORS:
+            if head.startswith(magic):
+                for cmd in cmds:
+                    if shutil.which(cmd[0]):
+                        return cmd
+                return cmds[-1]
+        return None
+
+    # Extract an uncompressed tar stream into dest
+    def _untar_stream(self, source: BinaryIO, tarball_name: str, dest: str) -> None:
+        try:
+            with _NoMtimeTarFile.open(
+                fileobj=source,
+                mode="r|",
+                bufsize=TAR_BUFSIZE,
+                copybufsize=TAR_BUFSIZE,
+            ) as tar:
+                tar.extractall(dest)
+        except tarfile.TarError as e:
+            print(f"Error: extracting {tarball_name} failed: {e}")
+            raise NixBuildError()
+
+    # Copy source into the decompressor; a broken pipe just means the
+    # extraction side gave up, which is reported there
+    def _feed(self, source: BinaryIO, sink: BinaryIO) -> None:
+        try:
+            shutil.copyfileobj(source, sink, TAR_BUFSIZE)
+        except (BrokenPipeError, ValueError):
+            pass
+        finally:
+            try:
+                sink.close()
+            except BrokenPipeError:
+                pass
+
+    # Decompress a tarball in a separate process and extract it as a stream,
+    # so decompression and extraction run on different cores. The format is
+    # detected from the data, as tarfile.open would, not from the name
+    def _extract_tarball(self, source: BinaryIO, tarball_name: str, dest: str) -> None:
+        head = source.read(_MAGIC_LEN)
+        stream = _PrefixedStream(head, source)
+        cmd = self._decompress_cmd(head)
+        if cmd is None:
+            self._untar_stream(stream, tarball_name, dest)
+            return
+        # Leaving the with block closes our pipe ends and reaps the process,
+        # even when extraction fails part way through
+        with subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        ) as dec:
+            feeder = threading.Thread(target=self._feed, args=(stream, dec.stdin))
+            feeder.start()
+            try:
+                self._untar_stream(dec.stdout, tarball_name, dest)
+                # tarfile stops at the end-of-archive marker; drain the record
+                # padding so the decompressor isn't killed writing it
+                while dec.stdout.read(TAR_BUFSIZE):
+                    pass
+            finally:
+                # Unblocks the decompressor, and with it the feeder, on failure
+                dec.stdout.close()
+                feeder.join()
+        if dec.returncode != 0:
+            print(f"Error: decompressing {tarball_name} failed")
+            raise NixBuildError()
 
     def _patch_bootstrap(self, nix_repo_root: str) -> bool:
         # Patch the bootstrap to not fail on binary patching failures
@@ -102,16 +241,16 @@ class NixHelper:
     # Run the setup commands for the nix binaries
     def initial_setup(self, extractedpath: str) -> None:
         # Equivalent to source nix.sh
-        with self._set_enviromentals():
-            # Load DB
-            with open(os.path.join(extractedpath, ".reginfo")) as regin:
-                subprocess.run([self.nix_store, "--load-db"], stdin=regin)
-            # Setup profile
-            subprocess.run([self.nix_env, "-i", Paths.NIX_PACKAGE])
-            # SSL
-            subprocess.run([self.nix_env, "-i", Paths.CA_PACKAGE])
-            # Show version
-            subprocess.run([self.nix_env, "--version"])
+        env = self._build_env()
+        # Load DB
+        with open(os.path.join(extractedpath, ".reginfo")) as regin:
+            subprocess.run([self.nix_store, "--load-db"], stdin=regin, env=env)
+        # Setup profile
+        subprocess.run([self.nix_env, "-i", Paths.NIX_PACKAGE], env=env)
+        # SSL
+        subprocess.run([self.nix_env, "-i", Paths.CA_PACKAGE], env=env)
+        # Show version
+        subprocess.run([self.nix_env, "--version"], env=env)
 
     # Is nix2rpm prepared?
     def is_installed(self) -> bool:
@@ -119,21 +258,22 @@ class NixHelper:
         nix_binary = os.path.exists(Paths.NIX_BINARY)
         return current_nix_installed and nix_binary
 
-    # Return list of pkgs matching searchterm from all nix pkgs
+    # Return list of pkgs matching searchterm from all nix pkgs, shortest first
     def search(self, term: str) -> List[str]:
-        packages = self.get_all_remote_packages()
-        rank = []
-        for package in packages:
+        # Package names are short, so bucket matches by length rather than
+        # sorting them; only the handful of distinct lengths gets sorted
+        by_length = defaultdict(list)
+        for package in self.get_all_remote_packages():
             if term in package:
-                rank.append(package)
-        sorted_rank = sorted(rank, key=lambda x: len(x))
-        return sorted_rank
+                by_length[len(package)].append(package)
+        return [pkg for length in sorted(by_length) for pkg in by_length[length]]
 
     # Switch to a new profile to prevent reactions with prior installed packages
     def switch_profile(self, name: str) -> None:
         profile_path = os.path.join(Paths.NIX_PROFILES, "nix2rpm_" + name)
-        with self._set_enviromentals():
-            subprocess.run([self.nix_env, "--switch-profile", profile_path])
+        subprocess.run(
+            [self.nix_env, "--switch-profile", profile_path], env=self._build_env()
+        )
 
     # Shell out to nix to install a package, returns package name
     def build_pkg(
@@ -148,179 +288,209 @@ class NixHelper:
         has_error = False
         # TODO: customize this
         build_result_dir = "build_result"
-        with self._set_enviromentals(force):
-            url = ""
-            nix_channel_regepx = re.compile(r"^\d\d\.\d\d(-pre|-beta)?$")
-            if repo.lower() == "unstable" or nix_channel_regepx.match(repo.lower()):
-                url = "https://github.com/NixOS/nixpkgs/archive/nixos-{}.tar.gz".format(
-                    repo
-                )
-            elif repo.lower() == "master":
-                url = "https://github.com/NixOS/nixpkgs/archive/master.tar.gz"
-            else:
-                url = repo
-
-            print("Looking for existing nix_repo folder")
-            # Check to see if we've got a recent copy of the nixpkgs repo
-            nix_repo_unpack_dir = os.path.join(
-                pathlib.Path(__file__).parent.parent.resolve(), "nix_repo"
+        env = self._build_env(force)
+        url = ""
+        if repo.lower() == "unstable" or _NIX_CHANNEL_RE.match(repo.lower()):
+            url = "https://github.com/NixOS/nixpkgs/archive/nixos-{}.tar.gz".format(
+                repo
             )
+        elif repo.lower() == "master":
+            url = "https://github.com/NixOS/nixpkgs/archive/master.tar.gz"
+        else:
+            url = repo
+
+        print("Looking for existing nix_repo folder")
+        # Check to see if we've got a recent copy of the nixpkgs repo
+        nix_repo_unpack_dir = os.path.join(
+            pathlib.Path(__file__).parent.parent.resolve(), "nix_repo"
+        )
 
-            if not self.is_folder_old(nix_repo_unpack_dir):
-                print("Existing folder is younger than an hour, using it")
-            else:
-                print("Downloading nixpkgs tarball from Github")
-                nio = NetworkIOHelper()
-                nio._download_file_curl(url, "repo.tar.gz")
-                if not os.path.isfile("repo.tar.gz"):
-                    print("Error: can't find downloaded repo file.")
-                    raise NixBuildError()
-
-                print("Extracting downloaded tarball")
-                # Extract the tarball to a folder called nix_repo
-                if os.path.isdir("nix_repo"):
-                    shutil.rmtree("nix_repo")
-                file = tarfile.open("repo.tar.gz")
-                file.extractall("./nix_repo")
-                file.close()
-
-            print("Configuring repo root")
-            nix_repo_root = ""
-            if os.path.exists("./nix_repo/default.nix"):
-                nix_repo_root = os.path.dirname("./nix_repo/")
-            # Newer versions use the nixos subfolder
-            if os.path.exists("./nix_repo/nixos/default.nix"):
-                nix_repo_root = os.path.dirname("./nix_repo/nixos/")
+        if not self.is_folder_old(nix_repo_unpack_dir):
+            print("Existing folder is younger than an hour, using it")
+        else:
+            # Extract next to nix_repo and only swap it in once the download
+            # and extraction both succeeded, so a failed update keeps the old
+            # tree; a leftover from an interrupted run is cleared first
+            staging = "nix_repo.partial"
+            if os.path.isdir(staging):
+                shutil.rmtree(staging)
+            print("Downloading and extracting nixpkgs tarball from Github")
+            # Stream curl straight into the extractor, no repo.tar.gz on disk
+            extract_error = None
+            with subprocess.Popen(
+                ["/usr/bin/curl", "-L", "--fail", url], stdout=subprocess.PIPE
+            ) as curl:
+                try:
+                    self._extract_tarball(curl.stdout, url, staging)
+                except NixBuildError as e:
+                    extract_error = e
+                finally:
+                    # Closing our end stops curl if extraction bailed out early
+                    curl.stdout.close()
+                    curl.wait()
+            # 23 is curl's write error from us closing the pipe; anything else
+            # is a failed download, which is also why the extraction failed
+            if curl.returncode not in (0, 23):
+                print("Error: can't download nixpkgs tarball.")
+                raise NixBuildError() from extract_error
+            if extract_error is not None:
+                raise extract_error
+            if os.path.isdir("nix_repo"):
+                shutil.rmtree("nix_repo")
+            os.rename(staging, "nix_repo")
+
+        print("Configuring repo root")
+        nix_repo_root = ""
+        if os.path.exists("./nix_repo/default.nix"):
+            nix_repo_root = os.path.dirname("./nix_repo/")
+        # Newer versions use the nixos subfolder
+        if os.path.exists("./nix_repo/nixos/default.nix"):
+            nix_repo_root = os.path.dirname("./nix_repo/nixos/")
+        else:
+            possible_globs = glob.glob("./nix_repo/*/default.nix", recursive=True)
+            if possible_globs:
+                nix_repo_root = os.path.dirname(possible_globs[0])
             else:
-                possible_globs = glob.glob("./nix_repo/*/default.nix", recursive=True)
-                if possible_globs:
-                    nix_repo_root = os.path.dirname(possible_globs[0])
-                else:
-                    print("Error: can't determine repo root.")
-                    raise NixBuildError()
-
-            print("Patch bootstrap script")
-            patched = self._patch_bootstrap(nix_repo_root)
-            if patched:
-                print("Bootstrap patch: Success!")
-            else:
-                print("Bootstrap patch: NO PATCHING HAPPENED! WEIRD!")
-
-            # Now we can build things!
-            print("Building package")
-            cmd = []
-            cmd.append(self.nix)
-            # # This seems to be necessary in 2.19+; it complains loudly otherwise
-            cmd.append("--extra-experimental-features")
-            cmd.append("nix-command")
-            cmd.append("--extra-experimental-features")
-            cmd.append("flakes")
-            cmd.append("build")
-            # cmd.append("-f")
-            # cmd.append(nix_repo_root + "/default.nix")
-            cmd.append("-o")
-            cmd.append(build_result_dir)
-            cmd.append("-j")
-            cmd.append(str(max_jobs))
-            if build_logs:
-                cmd.append("-L")
-            cmd.append(f"nixpkgs#{pkg_name}")
-            # Just in case it exists already
-            to_delete = glob.glob(f"{build_result_dir}*")
-            for entry in to_delete:
-                os.unlink(entry)
-            print("Running build command:")
-            print(" ".join(cmd))
-            p = subprocess.Popen(
-                cmd,
-                bufsize=1,  # Flush on every newline to ensure realtime
-                universal_newlines=True,
-            )
-            p.wait()
-            has_error = p.returncode != 0
-            if has_error:
-                print(f"Error: nix build command exit code: {p.returncode}")
+                print("Error: can't determine repo root.")
                 raise NixBuildError()
 
-            output_dirs = glob.glob(f"{build_result_dir}*")
+        print("Patch bootstrap script")
+        patched = self._patch_bootstrap(nix_repo_root)
+        if patched:
+            print("Bootstrap patch: Success!")
+        else:
+            print("Bootstrap patch: NO PATCHING HAPPENED! WEIRD!")
+
+        # Now we can build things!
+        print("Building package")
+        cmd = []
+        cmd.append(self.nix)
+        # # This seems to be necessary in 2.19+; it complains loudly otherwise
+        cmd.append("--extra-experimental-features")
+        cmd.append("nix-command")
+        cmd.append("--extra-experimental-features")
+        cmd.append("flakes")
+        cmd.append("build")
+        # cmd.append("-f")
+        # cmd.append(nix_repo_root + "/default.nix")
+        cmd.append("-o")
+        cmd.append(build_result_dir)
+        cmd.append("-j")
+        cmd.append(str(max_jobs))
+        if build_logs:
+            cmd.append("-L")
+        cmd.append(f"nixpkgs#{pkg_name}")
+        # Just in case it exists already
+        to_delete = glob.glob(f"{build_result_dir}*")
+        for entry in to_delete:
+            os.unlink(entry)
+        print("Running build command:")
+        print(" ".join(cmd))
+        p = subprocess.Popen(
+            cmd,
+            bufsize=1,  # Flush on every newline to ensure realtime
+            universal_newlines=True,
+            env=env,
+        )
+        p.wait()
+        has_error = p.returncode != 0
+        if has_error:
+            print(f"Error: nix build command exit code: {p.returncode}")
+            raise NixBuildError()
 
-            if not output_dirs:
-                print(f"Error: No build results found: {build_result_dir}*")
-                raise NixBuildError()
+        output_dirs = glob.glob(f"{build_result_dir}*")
 
-            for entry in output_dirs:
-                resulting_path = os.path.realpath(entry)
-                base_name = os.path.basename(resulting_path)
-                base_names.append(base_name)
+        if not output_dirs:
+            print(f"Error: No build results found: {build_result_dir}*")
+            raise NixBuildError()
+
+        for entry in output_dirs:
+            resulting_path = os.path.realpath(entry)
+            base_name = os.path.basename(resulting_path)
+            base_names.append(base_name)
 
         return base_names
 
     # Lists paths of all pkgs we should package to RPM based on requested one
     def get_pkgs_to_pack(self, pnames: List[str]) -> List[str]:
         # First, get the path of the requested package
-        dirlist = []
         root = Paths.NIX_STORE
-        for file in os.listdir(root):
-            for pname in pnames:
-                if pname in file and os.path.isdir(os.path.join(root, file)):
-                    dirlist.append(os.path.join(root, file))
+        # One compiled alternation scans each name once for all pnames
+        pattern = re.compile("|".join(map(re.escape, pnames))) if pnames else None
+
+        def matches(name: str) -> bool:
+            if len(pnames) <= 4:
+                return any(pname in name for pname in pnames)
+            return pattern.search(name) is not None
+
+        # DirEntry caches the file type, so is_dir costs no extra stat
+        with os.scandir(root) as it:
+            dirlist = [
+                entry.path
+                for entry in it
+                if matches(entry.name) and entry.is_dir(follow_symlinks=False)
+            ]
         if len(dirlist) == 0:
             raise NixPackagePathNotFoundError()
-        accum = []
-        for thisdir in dirlist:
-            # Then, shell out to get the path list
-            with self._set_enviromentals():
-                # all dependencies
-                result = subprocess.run(
-                    [self.nix_store, "--query", "--requisites", thisdir],
-                    capture_output=True,
-                )
-            accum.extend(result.stdout.decode().split())
-        return list(set(accum))  # remove duplicate paths
+        # Then, shell out once to get all dependencies of all of them
+        result = subprocess.run(
+            [self.nix_store, "--query", "--requisites", *dirlist],
+            capture_output=True,
+            env=self._build_env(),
+        )
+        return list(set(result.stdout.decode().split()))  # remove duplicate paths
 
     # Shell out & get result for nix-store --query --references
     def get_pkgs_references(self, pkg: str) -> List[str]:
-        with self._set_enviromentals():
-            # immediate dependencies only
-            result = subprocess.run(
-                [self.nix_store, "--query", "--references", pkg], capture_output=True
-            )
+        # immediate dependencies only
+        result = subprocess.run(
+            [self.nix_store, "--query", "--references", pkg],
+            capture_output=True,
+            env=self._build_env(),
+        )
         return result.stdout.decode().split()
 
     # Given a nix package path get the hash and name
     def separate_name_hash(self, path: str) -> Tuple[str, str]:
-        matched = re.match(r"^.*/([a-z0-9]{32})-(.*)$", path)
-        if not matched:
+        # Store names are fixed-format, so slice instead of matching a regex
+        base = os.path.basename(path)
+        nixhash = base[:_NIX_HASH_LEN]
+        if (
+            len(base) <= _NIX_HASH_LEN
+            or base[_NIX_HASH_LEN] != "-"
+            or not _NIX_HASH_CHARS.issuperset(nixhash)
+        ):
             raise RuntimeError("Path did not match pattern when trying to separate")
-        nixhash = matched.group(1)
-        name = matched.group(2)
+        # The hash has no "-", so the first one is the separator checked above
+        name = base.partition("-")[2]
         return nixhash, name
 
     def add_cross_compile_pkgs(
         self, pkgs: List, arm: bool = False, x86: bool = False
     ) -> List:
-        new_pkgs = []
-
         # No flags -> just keep the package
         if arm is False and x86 is False:
             return pkgs
 
+        # Decide once which flag means native and which means cross
+        if Architecture.is_x86():
+            native_ok, cross_ok, cross_prefix = x86, arm, "pkgsCross.aarch64-darwin."
+        elif Architecture.is_arm():
+            native_ok, cross_ok, cross_prefix = arm, x86, "pkgsCross.x86_64-darwin."
+        else:
+            native_ok, cross_ok, cross_prefix = False, False, ""
+
+        new_pkgs = []
         for pkg in pkgs:
             # If it's already a cross compile package,
             # we just take it as is
             if "pkgsCross" in pkg:
                 new_pkgs.append(pkg)
-            else:
-                if Architecture.is_x86():
-                    if x86:
-                        new_pkgs.append(pkg)
-                    if arm:
-                        new_pkgs.append(f"pkgsCross.aarch64-darwin.{pkg}")
-                if Architecture.is_arm():
-                    if arm:
-                        new_pkgs.append(pkg)
-                    if x86:
-                        new_pkgs.append(f"pkgsCross.x86_64-darwin.{pkg}")
+                continue
+            if native_ok:
+                new_pkgs.append(pkg)
+            if cross_ok:
+                new_pkgs.append(cross_prefix + pkg)
         return new_pkgs
 
     # Return the age of the folder in seconds
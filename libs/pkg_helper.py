@@ -1,9 +1,24 @@
 #!/usr/bin/env python3
+import functools
+import logging
 import os
-import shutil
 import subprocess
-import tempfile
-from typing import List
+from typing import List, NamedTuple, Optional
+
+from libs.system_helper import run_until_failure
+
+# Component pkgs are built in worker threads; log instead of printing so
+# diagnostics stay quiet by default and don't contend for stdout
+logger = logging.getLogger(__name__)
+
+
+# Everything build_component_pkg needs to know about one component
+class ComponentSpec(NamedTuple):
+    root_dir: str
+    identifier: str
+    version: str
+    pkg_name: str
+    pkg_hash: str
 
 
 # Process:
@@ -32,14 +47,32 @@ class PkgHelper:
         pkg_name = os.path.join(output_dir, self._dist_pkg_name(pkg_name))
         cmd.append(pkg_name)
 
-        result = subprocess.run(cmd, capture_output=True)
+        # Progress output can be large; only keep stderr, for failures
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
         if not result.returncode == 0:
-            print(result.stdout)
             print(result.stderr)
         else:
             print(f"Package found at {pkg_name}")
         return result.returncode == 0
 
+    # Create component packages in parallel, returning each one's success in
+    # order; stops at the first failure, so the list can be shorter than
+    # components
+    def build_component_pkgs(
+        self,
+        components: List[ComponentSpec],
+        output_dir: str,
+        max_jobs: Optional[int] = None,
+    ) -> List[bool]:
+        if len(components) == 0:
+            return []
+        workers = min(max_jobs or min(8, os.cpu_count() or 1), len(components))
+        jobs = (
+            functools.partial(self.build_component_pkg, *component, output_dir)
+            for component in components
+        )
+        return run_until_failure(jobs, workers)
+
     # Create a component package file, throw error if package did not succeed
     def build_component_pkg(
         self,
@@ -50,40 +83,52 @@ class PkgHelper:
         pkg_hash: str,
         output_dir: str,
     ) -> bool:
-        with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmproot:
-            # Copy actual root into tmproot
-            fixed_root = os.path.join(tmproot, root_dir.lstrip("/"))
-            # print(f"Copying {root_dir} into {tmproot}")
-            shutil.copytree(root_dir, fixed_root, symlinks=True, ignore_dangling_symlinks=True, dirs_exist_ok=True)
-            cmd = [
-                "/usr/bin/pkgbuild",
-                "--root",
-                tmproot,
-                "--identifier",
-                identifier,
-                "--version",
-                version,
-                os.path.join(output_dir, self._comp_pkg_name(pkg_name, pkg_hash)),
-            ]
-            # print("pkgbuild command: ")
-            # print(" ".join(cmd))
-            # print("Running pkgbuild command")
-            result = subprocess.run(cmd, capture_output=True)
+        output_path = os.path.join(output_dir, self._comp_pkg_name(pkg_name, pkg_hash))
+        # Store paths are content-addressed, so a pkg named after this hash
+        # was built from exactly this input already
+        if os.path.exists(output_path):
+            return True
+        # pkgbuild reads the store path in place and installs it back to the
+        # same location, so nothing has to be copied into a staging root
+        cmd = [
+            "/usr/bin/pkgbuild",
+            "--root",
+            root_dir,
+            "--install-location",
+            root_dir,
+            "--identifier",
+            identifier,
+            "--version",
+            version,
+            output_path,
+        ]
+        logger.debug("Running pkgbuild command: %s", cmd)
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
         if not result.returncode == 0:
-            print(result.stdout)
-            print(result.stderr)
+            logger.error(
+                "pkgbuild failed for %s: %s",
+                pkg_name,
+                result.stderr.decode("utf-8", "replace"),
+            )
         return result.returncode == 0
 
     # Generate component package name based on package name and version/hash
-    def _comp_pkg_name(self, pkg_name: str, pkg_hash: str) -> str:
+    # Names are pure functions of their inputs, so these are memoized
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _comp_pkg_name(pkg_name: str, pkg_hash: str) -> str:
         name = f"{pkg_name}-{pkg_hash}.pkg"
         # sanitization because this symbol causes errors with some web hosts
-        name = name.replace("+", "plus")
+        if "+" in name:
+            name = name.replace("+", "plus")
         return name
 
     # Generate dist package name
-    def _dist_pkg_name(self, pkg_name: str) -> str:
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _dist_pkg_name(pkg_name: str) -> str:
         name = f"nix2pkg-{pkg_name}.pkg"
         # sanitization because this symbol causes errors with some web hosts
-        name = name.replace("+", "plus")
+        if "+" in name:
+            name = name.replace("+", "plus")
         return name
@@ -1,84 +1,81 @@
 #!/usr/bin/env python3
+import functools
+import glob
 import os
+import re
 import shutil
 import subprocess
-from typing import List, Tuple
+from typing import List, Optional, TextIO, Tuple
 
 from libs.system_helper import Architecture
 
 
 class RPMHelper:
-    # Setting absolute paths for rpmbuild
-    topdir = os.path.join(os.getcwd(), "topdir")
-    rpmdir = os.path.join(os.getcwd(), "output")
-    tmppath = os.path.join(os.getcwd(), "rpm-tmp")
+    # Setting absolute paths for rpmbuild, under root (default: the working
+    # directory when the helper is created, not when the module is imported)
+    def __init__(self, root: Optional[str] = None) -> None:
+        root = os.path.abspath(root if root else os.getcwd())
+        self.topdir = os.path.join(root, "topdir")
+        self.rpmdir = os.path.join(root, "output")
+        self.tmppath = os.path.join(root, "rpm-tmp")
 
-    # Writing spec file lines to file
-    def write_lines(self, file_path: str, contents: str) -> None:
-        with open(file_path, "w") as f:
-            f.write(contents)
+    # Crosscompiled package names carry the target triple, e.g.
+    # aarch64-apple-darwin- or (unconfirmed) x86_64-apple-darwin-
+    _ARCH_RE = re.compile(r"(aarch64|x86_64)-apple-darwin-")
 
     def get_build_arch(self, pkg_name) -> str:
+        # Clean up crosscompilation names and set the right arch.
+        # 'arm64' is what apple calls uname -m on an apple silicon mac,
+        # but aarch64 is what is defined in RPM already.
+        matched = self._ARCH_RE.search(pkg_name)
+        if matched:
+            return matched.group(1)
         # Unless we crosscompile, we can pick the native architecture
         # of the machine that compiled the code.
-        build_arch = "aarch64" if Architecture.is_arm() else "x86_64"
+        return "aarch64" if Architecture.is_arm() else "x86_64"
 
-        # Now to clean up crosscompilation names and set the right arch.
-        if "aarch64-apple-darwin-" in pkg_name:
-            # 'arm64' is what apple calls uname -m
-            # on an apple silicon mac, but aarch64 is what is defined
-            # in RPM already.
-            build_arch = "aarch64"
-        # I assume that's what it will look like if we crosscompile
-        # on an arm mac to intel code. Unconfirmed.
-        if "x86_64-apple-darwin-" in pkg_name:
-            build_arch = "x86_64"
-        return build_arch
-
-    # Create a spec file based on some package information
+    # Write a spec file based on some package information straight
+    # into file_obj, one line at a time
     def generate_spec(
         self,
+        file_obj: TextIO,
         pkg_path: str,
         pkg_name: str,
         pkg_hash: str,
         deps_pairs: List[Tuple[str, str]],
-    ) -> str:
-        # Make the "Requires:..."" line
-        req_line = "Requires:"
-        nodeps = True
-        for dep_hash, dep_name in deps_pairs:
-            if dep_hash != pkg_hash:
-                req_line = req_line + " " + self._rpm_name(dep_name, dep_hash)
-                nodeps = False
-        if nodeps:
-            req_line = None
-        # List of strings representing the spec file
-        specfile_contents = [
-            "Name: " + self._rpm_name(pkg_name, pkg_hash),
-            # Note: sadly we can't specify BuildArch in here
-            # We will pass it to the rpmbuild command.
-            "Version: 1",
-            "Release: 0",
-            "Summary: Nix2RPM",
-            "Group: Nix2RPM",
-            "License: MIT",
-            "AutoReq: No",
-            "AutoProv: No",
-            "Packager: nix2rpm",
-            req_line,
-            "%description",
-            f"Packaged {pkg_name} with hash {pkg_hash} using nix2rpm",
-            "%install",
-            "mkdir -p $RPM_BUILD_ROOT/opt/facebook/nix/store/",
-            f"cp -a {pkg_path} $RPM_BUILD_ROOT/opt/facebook/nix/store/",
-            "%files",
-            pkg_path,
-            "%clean",
-            "chmod -R +w $RPM_BUILD_ROOT",
-            "rm -rf $RPM_BUILD_ROOT",
-        ]
-        specfile_contents = list(filter(None, specfile_contents))
-        return "\n".join(specfile_contents)
+    ) -> None:
+        write = file_obj.write
+        write(f"Name: {self._rpm_name(pkg_name, pkg_hash)}\n")
+        # Note: sadly we can't specify BuildArch in here
+        # We will pass it to the rpmbuild command.
+        write(
+            "Version: 1\n"
+            "Release: 0\n"
+            "Summary: Nix2RPM\n"
+            "Group: Nix2RPM\n"
+            "License: MIT\n"
+            "AutoReq: No\n"
+            "AutoProv: No\n"
+            "Packager: nix2rpm\n"
+        )
+        # Make the "Requires:..."" line, if there is anything to require
+        reqs = " ".join(
+            self._rpm_name(dep_name, dep_hash)
+            for dep_hash, dep_name in deps_pairs
+            if dep_hash != pkg_hash
+        )
+        if reqs:
+            write(f"Requires: {reqs}\n")
+        write("%description\n")
+        write(f"Packaged {pkg_name} with hash {pkg_hash} using nix2rpm\n")
+        write("%install\n")
+        write("mkdir -p $RPM_BUILD_ROOT/opt/facebook/nix/store/\n")
+        write(f"cp -a {pkg_path} $RPM_BUILD_ROOT/opt/facebook/nix/store/\n")
+        write("%files\n")
+        write(f"{pkg_path}\n")
+        write("%clean\n")
+        write("chmod -R +w $RPM_BUILD_ROOT\n")
+        write("rm -rf $RPM_BUILD_ROOT")
 
     # Shell out to rpmbuild
     def rpmbuild(self, specfile: str, build_arch: str) -> bool:
@@ -103,6 +100,13 @@ class RPMHelper:
         was_success = r == 0
         return was_success
 
+    # Has an RPM for this store path already been built into rpmdir?
+    # Store hashes are content-addressed, so the name identifies the input
+    def is_built(self, pkg_name: str, pkg_hash: str) -> bool:
+        # rpmbuild writes <rpmdir>/<arch>/<name>-<version>-<release>.<arch>.rpm
+        rpm_file = f"{self._rpm_name(pkg_name, pkg_hash)}-1-0.*.rpm"
+        return bool(glob.glob(os.path.join(glob.escape(self.rpmdir), "*", rpm_file)))
+
     # Delete temp files used during the RPM building process
     def cleanup(self) -> None:
         if os.path.exists(self.tmppath):
@@ -114,9 +118,13 @@ class RPMHelper:
             shutil.rmtree(self.rpmdir)
 
     # Come up with the RPM name based on package name and version/hash
-    def _rpm_name(self, pkg_name: str, pkg_hash: str) -> str:
+    # Memoized: the same deps show up in the Requires: of many specs
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _rpm_name(pkg_name: str, pkg_hash: str) -> str:
         name = f"nix2rpm-{pkg_name}-{pkg_hash}"
         # sanitization because this symbol will not svnyum publish
         # it causes T71552737 error
-        name = name.replace("+", "plus")
+        if "+" in name:
+            name = name.replace("+", "plus")
         return name
@@ -1,11 +1,48 @@
+import functools
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List
 
 
+# The architecture can't change at runtime, so each check runs os.uname() once
 class Architecture:
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def is_arm() -> bool:
         return "ARM64" in os.uname().version
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def is_x86() -> bool:
         return "X86_64" in os.uname().version
+
+
+# Run jobs (callables returning success) on up to max_jobs threads; meant for
+# work that waits on subprocesses. The next job is only taken from jobs once a
+# thread is free, and none are taken after the first failure, so the results
+# (in job order) can be fewer than the jobs
+def run_until_failure(jobs: Iterable[Callable[[], bool]], max_jobs: int) -> List[bool]:
+    slots = threading.BoundedSemaphore(max_jobs)
+    failed = threading.Event()
+
+    def job_done(future) -> None:
+        # Flag the failure before freeing the slot the producer waits on
+        if future.exception() is not None or not future.result():
+            failed.set()
+        slots.release()
+
+    futures = []
+    jobs = iter(jobs)
+    with ThreadPoolExecutor(max_workers=max_jobs) as ex:
+        while True:
+            slots.acquire()
+            if failed.is_set():
+                break
+            job = next(jobs, None)
+            if job is None:
+                break
+            future = ex.submit(job)
+            future.add_done_callback(job_done)
+            futures.append(future)
+    return [future.result() for future in futures]
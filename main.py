@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 
-import glob
+import functools
 import os
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
 
 import click
 
 from libs.io_helper import LocalIOHelper, NetworkIOHelper, Paths
 from libs.nix_helper import NixBuildError, NixHelper
-from libs.pkg_helper import PkgHelper
+from libs.pkg_helper import ComponentSpec, PkgHelper
 from libs.rpm_helper import RPMHelper
+from libs.system_helper import run_until_failure
 
 
 @click.group(epilog="Example: get ffmpeg RPMs: nix2pkg prepare, nix2pkg package ffmpeg")
@@ -39,8 +42,9 @@ def prepare() -> None:
             nix.initial_setup(extracted)
             click.echo("Finished install.")
         except Exception as e:
-            click.echo("Error\n" + str(e))
-            if click.confirm("Details?"):
+            click.echo(f"Error: {e}")
+            # Opt-in via env var instead of a prompt, so this never blocks
+            if os.environ.get("NIX2PKG_TRACEBACK"):
                 traceback.print_exc()
         finally:
             click.echo("Cleaning leftover files")
@@ -130,17 +134,20 @@ def package(
     try:
         pkgs = nix.add_cross_compile_pkgs(pkgs, arm, x86)
         click.echo(f"Starting to package: {str(pkgs)}")
-        rpm_error = False
         # click.echo("Owning store as facebook.")
         # io.own_store("facebook")
         # Clean the rpm output folder so
         # we don't have old stuff in there
         click.echo("Cleaning up RPM 'output' directory.")
         rpm.clean_output()
+        # Make a new temp dir; spec files are written here by absolute path
+        # so nothing depends on (or changes) the working directory
+        packages_dir = os.path.abspath("packages")
+        os.makedirs(packages_dir, exist_ok=True)
         for package in pkgs:
             # If a previous rpm failed to package,
             # let's stop building stuff
-            if rpm_error:
+            if pkg_error:
                 break
             click.echo(f"Building: {package}")
             click.echo(f"Using repo: {repo}")
@@ -151,35 +158,42 @@ def package(
             # click.echo(f"Preparing to package: {base_names}")
             all_pkgs = nix.get_pkgs_to_pack(base_names)
             # click.echo(f"Packages to pack: {all_pkgs}")
-            # Make a new temp dir
-            packages_dir = os.path.join(os.curdir, "packages")
-            os.makedirs(packages_dir, exist_ok=True)
-            os.chdir(packages_dir)
+            # Only RPMs record dependencies; query them all up front and
+            # concurrently rather than one nix-store call per loop iteration
+            deps_map = {}
+            if not pkg:
+                with ThreadPoolExecutor(max_workers=max_jobs) as ex:
+                    deps_map = dict(
+                        zip(all_pkgs, ex.map(nix.get_pkgs_references, all_pkgs))
+                    )
+            components = []
+            rpms = []
             for pkg_path in all_pkgs:
                 pkg_hash, pkg_name = nix.separate_name_hash(pkg_path)
                 click.echo(f"Packaging: {pkg_name}")
-                deps = nix.get_pkgs_references(pkg_path)
-                deps_pairs = [nix.separate_name_hash(p) for p in deps]
-                # click.echo(f"Dependencies: {deps_pairs}")
                 if pkg:
                     # print(f"Package path: {pkg_path}")
                     if not os.path.isdir(pkg_path):
                         continue
-                    success: bool = create_cpkg(
-                        nix_paths,
-                        pkgh,
-                        pkg_path,
-                        pkg_name,
-                        pkg_hash,
-                    )
+                    # Component packages are independent, built together below
+                    components.append((pkg_path, pkg_name, pkg_hash))
                 else:
-                    success: bool = create_rpm(
-                        rpm, pkg_path, pkg_name, pkg_hash, deps_pairs
+                    deps = deps_map[pkg_path]
+                    # Order-preserving de-dup; a dep only needs one Requires: entry
+                    deps_pairs = list(
+                        dict.fromkeys(nix.separate_name_hash(p) for p in deps)
                     )
+                    # click.echo(f"Dependencies: {deps_pairs}")
+                    # RPMs are independent too, built together below
+                    rpms.append((pkg_path, pkg_name, pkg_hash, deps_pairs))
+            if rpms:
+                success: bool = create_rpms(rpm, rpms, packages_dir, max_jobs)
+                if not success:
+                    pkg_error = True
+            if components:
+                success: bool = create_cpkgs(nix_paths, pkgh, components, max_jobs)
                 if not success:
                     pkg_error = True
-                    click.echo(f"Packaging error: {pkg_path}")
-                    break
         if pkg:
             click.echo("Building distribution package")
             # We take the first package from the list to use as our primary
@@ -206,34 +220,63 @@ def package(
         exit(1)
 
 
-# Create the RPM
-def create_rpm(rpm: RPMHelper, pkg_path, pkg_name, pkg_hash, deps_pairs) -> bool:
+# Write the RPM spec file, returning it and the arch to build it for
+def create_rpm_spec(
+    rpm: RPMHelper, packages_dir: str, pkg_path, pkg_name, pkg_hash, deps_pairs
+) -> Tuple[str, str]:
     print("Creating RPM")
-    spec_name = f"{pkg_name}-{pkg_hash}.spec"
-    spec_contents = rpm.generate_spec(pkg_path, pkg_name, pkg_hash, deps_pairs)
-    rpm.write_lines(spec_name, spec_contents)
+    spec_name = os.path.join(packages_dir, f"{pkg_name}-{pkg_hash}.spec")
+    with open(spec_name, "w", encoding="utf-8") as spec:
+        rpm.generate_spec(spec, pkg_path, pkg_name, pkg_hash, deps_pairs)
     build_arch = rpm.get_build_arch(pkg_name)
-    success = rpm.rpmbuild(spec_name, build_arch)
-    return success
+    return spec_name, build_arch
+
+
+# Create the RPMs, up to max_jobs rpmbuilds at a time. Each spec is written
+# just before its build starts, and nothing more is started after a failure
+def create_rpms(rpm: RPMHelper, rpms, packages_dir: str, max_jobs: int) -> bool:
+    pending = [args for args in rpms if not rpm.is_built(args[1], args[2])]
+
+    def jobs():
+        for args in pending:
+            spec_name, build_arch = create_rpm_spec(rpm, packages_dir, *args)
+            yield functools.partial(rpm.rpmbuild, spec_name, build_arch)
+
+    results = run_until_failure(jobs(), max_jobs)
+    for args, success in zip(pending, results):
+        if not success:
+            print(f"Packaging error: {args[0]}")
+    return all(results)
 
 
 # Create the component Apple packages
-def create_cpkg(nix_paths: Paths, pkg: PkgHelper, pkg_path, pkg_name, pkg_hash) -> bool:
-    print(f"Creating component package for {pkg_name}")
+def create_cpkgs(nix_paths: Paths, pkg: PkgHelper, components, max_jobs: int) -> bool:
+    specs = []
+    for pkg_path, pkg_name, pkg_hash in components:
+        print(f"Creating component package for {pkg_name}")
+        identifier = f"com.meta.nix2pkg.{pkg_hash}-{pkg_name}"
+        version = "1.0"
+        specs.append(ComponentSpec(pkg_path, identifier, version, pkg_name, pkg_hash))
     # Create the component packages
-    identifier = f"com.meta.nix2pkg.{pkg_hash}-{pkg_name}"
-    version = "1.0"
-    success = pkg.build_component_pkg(
-        pkg_path, identifier, version, pkg_name, pkg_hash, nix_paths.PACKAGES_OUT
-    )
-    return success
+    results = pkg.build_component_pkgs(specs, nix_paths.PACKAGES_OUT, max_jobs)
+    for spec, success in zip(specs, results):
+        if not success:
+            print(f"Packaging error: {spec.root_dir}")
+    return all(results)
 
 
 # Create the distribution Apple package out of the components
 def create_dpkg(nix_paths: Paths, pkgh: PkgHelper, pkg_name: str) -> bool:
     # Assume all the component package are in the "./packages" folder
     # print("Creating distribution package")
-    components = glob.glob(os.path.join(nix_paths.PACKAGES_OUT, "*.pkg"))
+    components = []
+    if os.path.isdir(nix_paths.PACKAGES_OUT):
+        with os.scandir(nix_paths.PACKAGES_OUT) as it:
+            components = [
+                entry.path
+                for entry in it
+                if entry.name.endswith(".pkg") and entry.is_file()
+            ]
     success = pkgh.build_dist_pkg(
         components, pkg_name, nix_paths.PACKAGES_OUT
     )